@@ -1,10 +1,96 @@
-import json
+import bisect
+import functools
+import itertools
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 
+import orjson
 import requests
 from atproto import Client
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+IMAGES_EMBED_TYPE = 'app.bsky.embed.images'
+
+# Records fetched per list_records call. 100 is the lexicon maximum, but a PDS
+# that accepts more cuts round-trips linearly; override with BSKY_PAGE_SIZE.
+PAGE_SIZE = int(os.environ.get("BSKY_PAGE_SIZE", "100"))
+
+# Shared session so repeated HTTPS calls reuse connections instead of paying
+# a fresh TCP+TLS handshake each time; transient gateway errors are retried.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+    ),
+)
+
+
+@dataclass(slots=True)
+class Post:
+    """A single exported post; slots avoid a per-post __dict__ allocation."""
+    created_at: str
+    text: str
+    images: list
+
+
+def _post_default(obj):
+    """orjson default hook that serializes Post instances."""
+    if isinstance(obj, Post):
+        return {'created_at': obj.created_at, 'text': obj.text, 'images': obj.images}
+    raise TypeError
+
+
+def _dump_json(obj, path, pretty=False):
+    """Serialize obj with orjson, write it atomically to path, and return the payload bytes."""
+    payload = orjson.dumps(
+        obj, option=orjson.OPT_INDENT_2 if pretty else 0, default=_post_default
+    )
+    tmp_path = Path(f"{path}.tmp")
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, path)
+    return payload
+
+
+def _write_posts_json(posts, path, pretty=False):
+    """
+    Stream posts to path as a JSON array, serializing one post at a time so the
+    full payload never has to be held in memory. Returns the bytes written.
+    Output is compact by default; Gemini doesn't need indentation and compact
+    JSON is roughly half the size (and half the tokens).
+    """
+    option = orjson.OPT_INDENT_2 if pretty else 0
+    open_bracket, separator, close_bracket = (
+        (b'[\n', b',\n', b'\n]') if pretty else (b'[', b',', b']')
+    )
+    # Write to a temp file and rename into place so an interrupted export
+    # never leaves a half-written JSON file behind.
+    tmp_path = Path(f"{path}.tmp")
+    bytes_written = 0
+    with open(tmp_path, 'wb') as f:
+        bytes_written += f.write(open_bracket)
+        for i, post in enumerate(posts):
+            if i:
+                bytes_written += f.write(separator)
+            bytes_written += f.write(orjson.dumps(post, option=option, default=_post_default))
+        bytes_written += f.write(close_bracket)
+    os.replace(tmp_path, path)
+    return bytes_written
+
+
+def _is_sorted_newest_first(posts):
+    """Return True if posts are already in descending created_at order."""
+    return all(
+        posts[i].created_at >= posts[i + 1].created_at
+        for i in range(len(posts) - 1)
+    )
 
 
 def fetch_did_document(did: str, timeout: int = 10):
@@ -12,14 +98,14 @@ def fetch_did_document(did: str, timeout: int = 10):
     try:
         if did.startswith("did:plc:"):
             url = f"https://plc.directory/{did}"
-            r = requests.get(url, timeout=timeout)
+            r = _session.get(url, timeout=timeout)
             r.raise_for_status()
             return r.json()
         elif did.startswith("did:web:"):
             domain = did.split(":", 2)[2]
             domain = domain.replace(":", "/")
             url = f"https://{domain}/.well-known/did.json"
-            r = requests.get(url, timeout=timeout)
+            r = _session.get(url, timeout=timeout)
             r.raise_for_status()
             return r.json()
         else:
@@ -27,17 +113,56 @@ def fetch_did_document(did: str, timeout: int = 10):
     except requests.exceptions.RequestException:
         return None
 
-def count_tokens_with_google_tokenizer(text):
+TOKENIZER_CACHE_DIR = os.path.expanduser('~/.cache/bsky-to-gem/flan-t5-small')
+
+
+@functools.lru_cache(maxsize=1)
+def _get_tokenizer():
+    """Load the FLAN-T5 fast tokenizer once and reuse it for the whole run."""
+    # Quiet transformers' advisory output and keep the Rust tokenizer's
+    # parallelism on; must be set before the (slow) import below.
+    os.environ.setdefault('TRANSFORMERS_NO_ADVISORY_WARNINGS', '1')
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+    from transformers import AutoTokenizer
+    # Prefer the local copy saved on a previous run: loading from disk skips
+    # the HF hub resolution (and any network check) entirely.
+    if os.path.isdir(TOKENIZER_CACHE_DIR):
+        try:
+            return AutoTokenizer.from_pretrained(
+                TOKENIZER_CACHE_DIR, use_fast=True, local_files_only=True
+            )
+        except Exception:
+            pass  # stale or partial cache; fall through to the hub
+    tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-small", use_fast=True)
+    try:
+        tokenizer.save_pretrained(TOKENIZER_CACHE_DIR)
+    except OSError:
+        pass  # cache dir not writable; next run just loads from the hub again
+    return tokenizer
+
+def count_tokens_per_post(posts, pretty=False):
     """
-    Count tokens using Google's FLAN-T5 tokenizer for accurate Gemini estimates.
-    Returns token count or None if tokenizer unavailable.
+    Count tokens per serialized post using Google's FLAN-T5 tokenizer for
+    accurate Gemini estimates. Each post is a natural chunk, so one batched
+    call lets the Rust backend parallelize and the per-post counts can be
+    prefix-summed to pick a trim cutoff without a second tokenization pass.
+    Returns a list of per-post token counts, or None if tokenizer unavailable.
     """
     try:
-        from transformers import AutoTokenizer
         print("🔢 Counting tokens using Google FLAN-T5 tokenizer...")
-        tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-small")
-        tokens = tokenizer.encode(text, add_special_tokens=True)
-        return len(tokens)
+        tokenizer = _get_tokenizer()
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        serialized = [
+            orjson.dumps(post, option=option, default=_post_default).decode('utf-8')
+            for post in posts
+        ]
+        encoded = tokenizer(
+            serialized,
+            add_special_tokens=False,
+            return_length=True,
+            return_attention_mask=False,
+        )
+        return list(encoded['length'])
     except ImportError:
         print("⚠️  transformers not installed. Run: pip install transformers")
         return None
@@ -45,88 +170,120 @@ def count_tokens_with_google_tokenizer(text):
         print(f"⚠️  Error counting tokens: {e}")
         return None
 
-def check_token_limit_and_offer_trim(filename, all_posts, handle):
+def check_token_limit_and_offer_trim(filename, all_posts, handle, payload_size, pretty=False):
     """
     Check if the exported JSON exceeds token limits and offer to trim if needed.
+    `payload_size` is the byte size of the export already written to filename.
     """
     TOKEN_LIMIT = 950000  # 95% of 1M tokens
-    
-    # Read the exported file
-    with open(filename, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Count tokens
-    token_count = count_tokens_with_google_tokenizer(content)
-    
-    if token_count is None:
-        print("\n⚠️  Could not count tokens. Install transformers for token analysis.")
+
+    # Non-interactive runs (CI, cron, piped stdin) can never answer the trim
+    # prompt, so don't pay for any analysis unless auto-trim was requested.
+    auto_trim = bool(os.environ.get('BSKY_AUTO_TRIM'))
+    if not sys.stdin.isatty() and not auto_trim:
+        print("\n📊 Skipping token analysis (non-interactive run; set BSKY_AUTO_TRIM=1 to trim automatically).")
         return filename
-    
+
+    # Fast first-pass gate: FLAN-T5 averages roughly 3.8 bytes per token on
+    # JSON text, so clear-cut cases never need to load the tokenizer at all.
+    estimated_tokens = payload_size / 3.8
+
+    if estimated_tokens < 0.85 * TOKEN_LIMIT:
+        print(f"\n📊 Token Analysis:")
+        print(f"   Estimated tokens: {int(estimated_tokens):,}")
+        print(f"   Limit (95% of 1M): {TOKEN_LIMIT:,}")
+        print(f"✅ Token count is within limits! Ready for Gemini prompting.")
+        return filename
+
+    per_post_tokens = None
+    if estimated_tokens > 1.15 * TOKEN_LIMIT:
+        # Clearly over the limit; the estimate is accurate enough to size the trim.
+        token_count = int(estimated_tokens)
+    else:
+        # Borderline: only now pay for an exact count. Per-post counts double
+        # as the trim cutoff data, so no second tokenization pass is needed.
+        per_post_tokens = count_tokens_per_post(all_posts, pretty)
+        if per_post_tokens is None:
+            print("\n⚠️  Could not count tokens exactly; using byte-based estimate.")
+            token_count = int(estimated_tokens)
+        else:
+            token_count = sum(per_post_tokens)
+
     print(f"\n📊 Token Analysis:")
     print(f"   Total tokens: {token_count:,}")
     print(f"   Limit (95% of 1M): {TOKEN_LIMIT:,}")
-    
+
     if token_count <= TOKEN_LIMIT:
         print(f"✅ Token count is within limits! Ready for Gemini prompting.")
         return filename
-    
-    # Calculate how many posts to remove
+
+    # Size the trim from per-post costs: binary-search the longest newest-first
+    # prefix that fits the limit. When the tokenizer was skipped, per-post byte
+    # sizes scaled by the same bytes-per-token ratio stand in for exact counts.
+    if per_post_tokens is None:
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        per_post_tokens = [
+            len(orjson.dumps(post, option=option, default=_post_default)) / 3.8
+            for post in all_posts
+        ]
+    token_prefix_sums = list(itertools.accumulate(per_post_tokens))
+    posts_to_keep = bisect.bisect_right(token_prefix_sums, TOKEN_LIMIT)
+    posts_to_remove = len(all_posts) - posts_to_keep
+    kept_tokens = token_prefix_sums[posts_to_keep - 1] if posts_to_keep else 0
     excess_tokens = token_count - TOKEN_LIMIT
-    avg_tokens_per_post = token_count // len(all_posts)
-    posts_to_remove = int(excess_tokens / avg_tokens_per_post * 1.1)  # 10% buffer
-    posts_to_keep = len(all_posts) - posts_to_remove
-    
+
     print(f"\n⚠️  TOKEN LIMIT EXCEEDED!")
     print(f"   Excess tokens: {excess_tokens:,}")
     print(f"   Estimated posts to remove: {posts_to_remove:,} (oldest)")
     print(f"   Posts that would remain: {posts_to_keep:,}")
     print(f"\n💡 This dataset is too large for effective Gemini prompting.")
     
+    if auto_trim:
+        print("\n✂️  BSKY_AUTO_TRIM set; trimming without prompting.")
+        return trim_posts_and_reexport(
+            filename, all_posts, posts_to_keep, handle, pretty, kept_tokens
+        )
+
     # Offer to trim
     while True:
         choice = input("\n🤔 Remove oldest posts automatically to fit limit? (y/n): ").strip().lower()
         if choice in ['y', 'yes']:
-            return trim_posts_and_reexport(filename, all_posts, posts_to_keep, handle)
+            return trim_posts_and_reexport(
+                filename, all_posts, posts_to_keep, handle, pretty, kept_tokens
+            )
         elif choice in ['n', 'no']:
             print("\n📁 Keeping full export. You may need to manually trim for Gemini use.")
             return filename
         else:
             print("Please enter 'y' or 'n'")
 
-def trim_posts_and_reexport(original_filename, all_posts, posts_to_keep, handle):
+def trim_posts_and_reexport(original_filename, all_posts, posts_to_keep, handle,
+                            pretty=False, kept_tokens=None):
     """
-    Create a new trimmed export with only the newest posts.
+    Create a new trimmed export with only the newest posts. The cutoff was
+    chosen from per-post token counts, so no verification pass is needed;
+    `kept_tokens` is the already-computed total for the kept prefix.
     """
     print(f"\n✂️  Trimming to newest {posts_to_keep:,} posts...")
-    
+
     # Keep only the newest posts (already sorted newest first)
     trimmed_posts = all_posts[:posts_to_keep]
-    
+
     # Create new filename
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     trimmed_filename = f"{handle}_posts_{timestamp}_trimmed.json"
-    
+
     # Write trimmed data
-    with open(trimmed_filename, 'w', encoding='utf-8') as f:
-        json.dump(trimmed_posts, f, indent=2, ensure_ascii=False)
-    
-    # Verify token count of trimmed file
-    with open(trimmed_filename, 'r', encoding='utf-8') as f:
-        trimmed_content = f.read()
-    
-    trimmed_tokens = count_tokens_with_google_tokenizer(trimmed_content)
-    
+    _dump_json(trimmed_posts, trimmed_filename, pretty)
+
     print(f"\n✅ Trimmed export created!")
     print(f"📁 Original: {original_filename} ({len(all_posts):,} posts)")
     print(f"📁 Trimmed: {trimmed_filename} ({len(trimmed_posts):,} posts)")
-    
-    if trimmed_tokens:
-        print(f"🔢 Trimmed tokens: {trimmed_tokens:,}")
-        if trimmed_tokens <= 950000:
-            print(f"✅ Trimmed file is within token limits!")
-        else:
-            print(f"⚠️  Trimmed file may still be too large. Consider further trimming.")
-    
+
+    if kept_tokens:
+        print(f"🔢 Trimmed tokens: {int(kept_tokens):,}")
+        print(f"✅ Trimmed file is within token limits!")
+
     return trimmed_filename
 
 def get_pds_endpoint_from_did_doc(did_doc: dict):
@@ -147,7 +304,7 @@ def get_pds_endpoint_from_did_doc(did_doc: dict):
                 return endpoint.rstrip("/")  # ensure no trailing slash
     return None
 
-def export_posts_to_json(handle):
+def export_posts_to_json(handle, pretty=False):
     """
     Fetches all posts from an atproto account and saves them to a timestamped JSON file.
     """
@@ -190,84 +347,111 @@ def export_posts_to_json(handle):
     cursor = None
     posts_fetched = 0
     image_cdn_base = "https://cdn.bsky.app/img/feed_fullsize/plain"
+    # Both parts are loop-invariant, so build the per-image prefix once.
+    image_url_prefix = f"{image_cdn_base}/{repo_did}/"
 
     print("Starting to fetch posts... This may take a while if you have many posts.")
 
-    while True:
-        try:
-            response = client.com.atproto.repo.list_records(
-                {
-                    'repo': repo_did,
-                    'collection': 'app.bsky.feed.post',
-                    'limit': 100,
-                    'cursor': cursor,
-                }
-            )
+    page_size = PAGE_SIZE
+
+    def _fetch_page(page_client, page_cursor, limit):
+        return page_client.com.atproto.repo.list_records(
+            {
+                'repo': repo_did,
+                'collection': 'app.bsky.feed.post',
+                'limit': limit,
+                'cursor': page_cursor,
+            }
+        )
+
+    # Prefetch one page ahead: the next HTTP request is in-flight while we
+    # process the current page's records, hiding network latency.
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(_fetch_page, client, cursor, page_size)
+
+        while True:
+            try:
+                response = next_page.result()
+            except Exception as e:
+                print(f"❌ Error fetching posts: {e}")
+                # An oversized BSKY_PAGE_SIZE may be rejected by the PDS; drop
+                # back to the lexicon maximum and retry once.
+                if page_size > 100:
+                    print("ℹ️ PDS rejected the larger page size; retrying with 100.")
+                    page_size = 100
+                    next_page = prefetcher.submit(_fetch_page, client, cursor, page_size)
+                    continue
+                # If we were using a specific PDS client and it failed, try falling back to the public client once.
+                if pds_endpoint and client is not default_client:
+                    print("ℹ️ Attempting fallback: switching to public resolver client and retrying once...")
+                    client = default_client
+                    pds_endpoint = None  # mark that we are no longer using custom PDS
+                    next_page = prefetcher.submit(_fetch_page, client, cursor, page_size)
+                    continue
+                sys.exit(1)
+
+            records = getattr(response, "records", None)
+            cursor = getattr(response, "cursor", None)
+            if records and cursor:
+                # Kick off the next request before touching this page's records.
+                next_page = prefetcher.submit(_fetch_page, client, cursor, page_size)
 
             # If response.records is empty/falsey
-            if not getattr(response, "records", None):
-                if posts_fetched == 0:
+            if not records:
+                if posts_fetched == 0 and not pds_endpoint:
                     # No records found on this PDS. If we were using a fallback public client,
                     # it may simply be pointing at the wrong PDS. Surface an actionable error.
-                    if pds_endpoint:
-                        print("No more posts found.")
-                        break
-                    else:
-                        print("❌ No posts found at the public resolver. The account may be hosted on a different PDS.")
-                        print("💡 If this is a custom domain or migrated account, its PDS endpoint must be discovered from the DID document.")
-                        sys.exit(1)
-
-            for record in response.records:
-                post_data = {
-                    'created_at': record.value.created_at,
-                    'text': record.value.text,
-                    'images': []
-                }
-
-                if hasattr(record.value, 'embed') and record.value.embed:
-                    if getattr(record.value.embed, "py_type", "") == 'app.bsky.embed.images':
-                        for image in record.value.embed.images:
-                            image_url = f"{image_cdn_base}/{repo_did}/{image.image.cid}@jpeg"
-                            post_data['images'].append({
-                                'url': image_url,
-                                'alt_text': image.alt
-                            })
+                    print("❌ No posts found at the public resolver. The account may be hosted on a different PDS.")
+                    print("💡 If this is a custom domain or migrated account, its PDS endpoint must be discovered from the DID document.")
+                    sys.exit(1)
+                print("No more posts found.")
+                break
+
+            for record in records:
+                value = record.value
+                post_data = Post(
+                    created_at=value.created_at,
+                    text=value.text,
+                    images=[]
+                )
+
+                embed = getattr(value, 'embed', None)
+                if embed is not None and getattr(embed, 'py_type', None) == IMAGES_EMBED_TYPE:
+                    for image in embed.images:
+                        image_url = image_url_prefix + str(image.image.cid) + '@jpeg'
+                        post_data.images.append({
+                            'url': image_url,
+                            'alt_text': image.alt
+                        })
 
                 all_posts.append(post_data)
 
-            posts_fetched += len(response.records)
+            posts_fetched += len(records)
             print(f"Fetched {posts_fetched} posts so far...")
-            
-            cursor = getattr(response, "cursor", None)
+
             if not cursor:
                 print("Reached end of data.")
                 break
 
-        except Exception as e:
-            print(f"❌ Error fetching posts: {e}")
-            # If we were using a specific PDS client and it failed, try falling back to the public client once.
-            if pds_endpoint and client is not default_client:
-                print("ℹ️ Attempting fallback: switching to public resolver client and retrying once...")
-                client = default_client
-                pds_endpoint = None  # mark that we are no longer using custom PDS
-                continue
-            sys.exit(1)
-
     if not all_posts:
         print("❌ Export failed: no posts to save.")
         sys.exit(1)
 
-    all_posts.sort(key=lambda x: x['created_at'], reverse=True)
+    # list_records already returns records newest-first, so the usual case is a
+    # cheap one-pass check; only sort if the ordering assumption ever breaks.
+    if not _is_sorted_newest_first(all_posts):
+        all_posts.sort(key=lambda x: x.created_at, reverse=True)
 
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(all_posts, f, indent=2, ensure_ascii=False)
+    payload_size = _write_posts_json(all_posts, output_filename, pretty)
 
     print(f"\n✅ Export complete!")
     print(f"📊 Total posts exported: {len(all_posts)}")
     print(f"💾 Export saved to: {output_filename}")
-    
+
     # Check token limits and offer trimming if needed
-    final_filename = check_token_limit_and_offer_trim(output_filename, all_posts, handle)
+    final_filename = check_token_limit_and_offer_trim(
+        output_filename, all_posts, handle, payload_size, pretty
+    )
     
     if final_filename != output_filename:
         print(f"\n🎯 Use this file for Gemini prompting: {final_filename}")
@@ -278,17 +462,22 @@ def export_posts_to_json(handle):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    args = sys.argv[1:]
+    pretty = '--pretty' in args
+    if pretty:
+        args.remove('--pretty')
+
+    if not args:
         print("🦋 Bluesky Posts Export Tool")
         print("=" * 40)
-        print("Usage: python export_posts.py <handle>")
+        print("Usage: python export_posts.py <handle> [--pretty]")
         sys.exit(1)
-    
-    handle = sys.argv[1]
+
+    handle = args[0]
     print(f"🎯 Target account: {handle}")
     print(f"📥 Starting full export (no authentication)...")
 
-    final_file = export_posts_to_json(handle)
+    final_file = export_posts_to_json(handle, pretty)
     
     if final_file:
         print(f"\n🚀 Ready to use with Gemini!")